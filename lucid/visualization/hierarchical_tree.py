@@ -3,131 +3,423 @@ Module containing functions for representing a Ruleset using a hierarchical
 tree.
 """
 
-from collections import defaultdict
-from lucid.rules.clause import ConjunctiveClause
-from lucid.rules.rule import Rule
-from lucid.rules.ruleset import Ruleset
+import re
+
+from collections import Counter, deque, namedtuple
 
 
 ################################################################################
 ## HTML/SVG Construction Helper Functions
 ################################################################################
 
+# Map between special characters and their corresponding HTML codes together
+# with a precompiled pattern matching any of them so that all substitutions
+# happen in a single scan of the input string
+_HTML_CODE_MAP = {
+    "<=": "&leq;",
+    ">=": "&geq;",
+}
+_HTML_CODE_RE = re.compile("|".join(map(re.escape, _HTML_CODE_MAP)))
+
+
 def _htmlify(s):
     """
     Turn the given string into HTML by substituting special characters in it
     with their corresponding HTML codes.
     """
-    for plain, html_code in [
-        ("<=", "&leq;"),
-        (">=", "&geq;"),
-    ]:
-        s = s.replace(plain, html_code)
-    return s
+    # Most labels (categorical or equality terms, conclusions) contain no
+    # special characters at all, so a couple of cheap containment checks let
+    # us skip the substitution machinery entirely in the common case
+    if ("<=" not in s) and (">=" not in s):
+        return s
+    return _HTML_CODE_RE.sub(lambda m: _HTML_CODE_MAP[m.group(0)], s)
 
 
 ################################################################################
 ## Hierarchical Tree Construction Methods
 ################################################################################
 
+# Lightweight view of a single (rule, clause) pair holding only what tree
+# construction actually needs; its terms live separately as an integer bitmask
+# so that no Rule or ConjunctiveClause objects are ever allocated here
+_RuleView = namedtuple("_RuleView", ["conclusion", "score"])
 
-def _get_term_counts(ruleset):
+
+def _get_term_counts(clause_masks):
     """
-    Generates a frequency distribution of all the terms in the rule set.
+    Generates a frequency distribution of all the terms used in the given
+    clause bitmasks (as produced by `_build_term_index`).
 
-    :param Ruleset ruleset: The ruleset whose term distribution we want to
-        obtain.
+    :param List[int] clause_masks: The term bitmasks of the clauses whose term
+        distribution we want to obtain.
 
-    :return Tuple[List[Term], Dict[Term, int]]: a tuple containing first the
-        list of all used terms in the rule set sorted in descended order of
-        use and a dictionary mapping each term to its corresponding count.
+    :return Counter[int]: a counter mapping each term bit to the number of
+        clauses using the corresponding term.
+    """
+    counts = Counter()
+    for mask in clause_masks:
+        # Peel off one set bit at a time; these are all C-level int
+        # operations so no Python-level set or attribute access is involved
+        while mask:
+            lsb = mask & -mask
+            counts[lsb] += 1
+            mask ^= lsb
+    return counts
+
+
+def _build_term_index(rules):
+    """
+    Builds a bit index of the given rules.
+
+    Every distinct term gets assigned a unique bit and every (rule, clause)
+    pair in the rule set gets assigned a unique integer rule ID and is
+    represented by the integer bitmask of its terms together with its score
+    and conclusion. This lets the rest of the construction test term
+    membership with a single integer AND and enumerate a clause's terms with
+    cheap bit operations.
+
+    :param Iterable[Rule] rules: The rules whose bit index we want to build.
+
+    :return Tuple[List[_RuleView], List[int], Dict[int, Term]]: a tuple
+        containing (1) a list mapping each rule ID to its rule view, (2) a
+        list mapping each rule ID to the bitmask of the
+        terms in its clause, and (3) a map between each term bit and the
+        corresponding Term object.
     """
-    num_used_rules_per_term_map = defaultdict(int)
-    all_terms = set()
-    for rule in ruleset.rules:
+    rule_views = []
+    clause_masks = []
+    term_to_bit = {}
+    bit_to_term = {}
+    for rule in rules:
+        if not len(rule.premise):
+            # Degenerate rule with an empty premise: it still gets a leaf
+            rule_views.append(_RuleView(conclusion=rule.conclusion, score=0))
+            clause_masks.append(0)
+            continue
         for clause in rule.premise:
+            rule_views.append(_RuleView(
+                conclusion=rule.conclusion,
+                score=clause.score,
+            ))
+            mask = 0
             for term in clause.terms:
-                all_terms.add(term)
-                num_used_rules_per_term_map[term] += 1
+                bit = term_to_bit.get(term)
+                if bit is None:
+                    bit = 1 << len(term_to_bit)
+                    term_to_bit[term] = bit
+                    bit_to_term[bit] = term
+                mask |= bit
+            clause_masks.append(mask)
+    return rule_views, clause_masks, bit_to_term
 
-    # Make sure we display most used rules first
-    used_terms = sorted(
-        list(all_terms),
-        key=lambda x: -num_used_rules_per_term_map[x],
-    )
-    return used_terms, num_used_rules_per_term_map
 
+def _build_label_cache(bit_to_term, rule_views, dataset=None):
+    """
+    Precomputes the HTML label of every distinct term and conclusion in the
+    rule set.
+
+    Each term typically appears in many rules and would otherwise get
+    re-stringified and re-`_htmlify`-ed once per node it shows up in, so we
+    memoize the conversions up front instead.
+
+    :param Dict[int, Term] bit_to_term: Map between each term bit and the
+        corresponding Term object.
+    :param List[_RuleView] rule_views: Map between each rule ID and its rule
+        view.
+    :param DatasetDescriptor dataset: An optional dataset descriptor for the
+        given rule set which can help with annotations during visualization.
 
-def _partition_ruleset(ruleset, term):
+    :return Tuple[Dict[int, str], Dict[object, str]]: a tuple containing a map
+        between each term bit and the HTML label of the corresponding term and
+        a map between each distinct conclusion and its HTML label.
     """
-    Partitions rule set `ruleset` into two rule sets (R1, R2) using term `term`
-    such that R1 will contain all rules in `ruleset` that use term `term` in
-    their premise and R2 will contain all other rules. All the rules in R1 will
-    be modified so that they do not explicitly use `term` in their premises any
-    more.
+    label_cache = {
+        bit: _htmlify(
+            term.to_cat_str(dataset) if dataset is not None else str(term)
+        )
+        for bit, term in bit_to_term.items()
+    }
+    conclusion_labels = {}
+    for view in rule_views:
+        if view.conclusion not in conclusion_labels:
+            conclusion_labels[view.conclusion] = _htmlify(
+                str(view.conclusion)
+            )
+    return label_cache, conclusion_labels
 
-    This function is used for creating our visualization of the rule sets as
-    trees by greedily grouping them according to the most used terms.
 
-    :param Ruleset ruleset: The rule set we will partition.
-    :param Term term: The term we want to partition the ruleset with.
+def _finalize_node(node):
     """
+    Fills in the `num_descendants` and `class_counts` annotations of the given
+    D3 node from the (already annotated) children in its subtree.
 
-    # This will be the equivalent of R1
-    contain_ruleset = Ruleset(
-        rules=set(),
-        feature_names=ruleset.feature_names,
-        output_class_names=list(ruleset.output_class_map.keys()),
-        regression=ruleset.regression,
-    )
+    :param d3.Node node: The node whose annotations we want to fill in. All of
+        its children are expected to have been finalized already.
+    """
+    if not node["children"]:
+        # Then this is a leaf!
+        node["num_descendants"] = 0
+        node["class_counts"] = {
+            node["name"]: 1,
+        }
+        return
+    node["num_descendants"] = 0
+    node["class_counts"] = {}
+    class_counts = node["class_counts"]
+    for child in node["children"]:
+        node["num_descendants"] += child["num_descendants"] + 1
+        for class_name, count in child["class_counts"].items():
+            class_counts[class_name] = count + class_counts.get(
+                class_name,
+                0
+            )
 
-    # This will be the equivalent of R2
-    disjoint_ruleset = Ruleset(
-        rules=set(),
-        feature_names=ruleset.feature_names,
-        output_class_names=list(ruleset.output_class_map.keys()),
-        regression=ruleset.regression,
-    )
-    for rule in ruleset.rules:
-        for clause in rule.premise:
-            found_term = False
-            for c_term in clause.terms:
-                if c_term == term:
-                    found_term = True
-                    break
-            if found_term:
-                # Then we found the term that we are looking for in this
-                # rule! That means we will add it while also modifying it so
-                # that the term is not included in its premise
-                contain_ruleset.rules.add(Rule(
-                    premise=set([
-                        ConjunctiveClause(
-                            terms=set(
-                                [t for t in clause.terms if t != term]
-                            ),
-                            confidence=clause.confidence,
-                            score=clause.score,
-                        ),
-                    ]),
-                    conclusion=rule.conclusion,
-                ))
-            else:
-                # Then add this guy into the disjoint ruleset
-                disjoint_ruleset.rules.add(Rule(
-                    premise=set([clause]),
-                    conclusion=rule.conclusion,
-                ))
-
-    return contain_ruleset, disjoint_ruleset
-
-
-def _extract_hierarchy_node(ruleset, dataset=None, merge=False):
+
+class _TrieNode(object):
+    """
+    A single node of the rule trie built by `_build_trie`.
+
+    Uses `__slots__` so that the (potentially very many) intermediate nodes
+    created during construction stay compact: only the D3 nodes emitted at
+    the boundary pay for full dicts.
+    """
+    __slots__ = ("children", "rule_ids", "count")
+
+    def __init__(self, count=0):
+        # Map between a term bit and the corresponding child node
+        self.children = {}
+        # IDs of the rules whose clause ends exactly at this node
+        self.rule_ids = []
+        # Number of rules whose path goes through this node (used to emit
+        # the most common branches first)
+        self.count = count
+
+
+def _build_trie(clause_masks, counts):
+    """
+    Builds a prefix tree (trie) of the given clause bitmasks where the terms
+    of each clause are ordered from globally most common to least common.
+
+    The grouping previously obtained by repeatedly partitioning the working
+    rule set around its most common term amounts to inserting every rule into
+    a trie keyed by descending global term frequency: rules sharing their
+    most common terms share a prefix and hence an ancestor path in the final
+    tree. Building that trie directly replaces the per-level re-partitioning
+    with a single pass over every term of every clause.
+
+    :param List[int] clause_masks: Map between each rule ID and the bitmask
+        of the terms in its clause.
+    :param Counter[int] counts: Map between each term bit and the number of
+        clauses using the corresponding term.
+
+    :return _TrieNode: the root node of the trie.
+    """
+    sort_keys = {bit: (-count, bit) for bit, count in counts.items()}
+    key_fn = sort_keys.__getitem__
+    root = _TrieNode(count=len(clause_masks))
+    # The construction is deterministic in the clause's term set, so clauses
+    # sharing the exact same mask can share their decomposed and sorted term
+    # sequence instead of recomputing it
+    order_cache = {}
+    for rule_id, mask in enumerate(clause_masks):
+        bits = order_cache.get(mask)
+        if bits is None:
+            key = mask
+            bits = []
+            while mask:
+                lsb = mask & -mask
+                bits.append(lsb)
+                mask ^= lsb
+            bits.sort(key=key_fn)
+            order_cache[key] = bits
+        node = root
+        for bit in bits:
+            children = node.children
+            child = children.get(bit)
+            if child is None:
+                child = _TrieNode()
+                children[bit] = child
+            child.count += 1
+            node = child
+        node.rule_ids.append(rule_id)
+    return root
+
+
+def _emit_rule_chain(labels, view, conclusion_labels, depth, merge=False):
+    """
+    Produces the fully annotated chain of D3 nodes for a single rule whose
+    trie path is not shared with any other rule.
+
+    Every rule ends in such a chain (possibly of length one) so this runs
+    once per leaf. Because the subtree is a straight line ending in a single
+    conclusion leaf, all of its annotations are known up front and the chain
+    can be built bottom-up in one pass with no work-stack involvement.
+
+    :param List[str] labels: The HTML labels of the chain's terms, from
+        shallowest to deepest.
+    :param _RuleView view: The view of the rule the chain belongs to.
+    :param Dict[object, str] conclusion_labels: Map between each distinct
+        conclusion in the rule set and its HTML label.
+    :param int depth: The depth of the topmost node in the chain.
+    :param bool merge: Whether or not we want to series of branches with only
+        one child into a single child with a longer premise or not.
+
+    :return d3.Node: the topmost node of the chain.
+    """
+    if merge:
+        # The entire chain compresses into a single conjunctive node
+        labels = [" AND ".join(labels)]
+    conclusion_label = conclusion_labels[view.conclusion]
+    node = {
+        "name": conclusion_label,
+        "children": [],
+        "score": view.score,
+        "depth": depth + len(labels),
+        "num_descendants": 0,
+        "class_counts": {
+            conclusion_label: 1,
+        },
+    }
+    for i, label in enumerate(reversed(labels)):
+        node = {
+            "name": label,
+            "children": [node],
+            "depth": depth + len(labels) - 1 - i,
+            "num_descendants": i + 1,
+            "class_counts": {
+                conclusion_label: 1,
+            },
+        }
+    return node
+
+
+def _trie_child_sort_key(entry):
+    """
+    Sort key ordering the (bit, child) entries of a trie node from most to
+    least common branch, with ties broken deterministically by term bit.
     """
-    Recursive function to produce a D3 Hierarchical Tree structure from the
-    given rule set.
+    return (-entry[1].count, entry[0])
 
-    This tree will be generated by producing branches in a greedy fashion such
-    that most commonly used terms are selected first for generating early split
+
+def _emit_trie(root, rule_views, label_cache, conclusion_labels, merge=False):
+    """
+    Produces the list of fully annotated D3 nodes corresponding to the given
+    rule trie (as produced by `_build_trie`).
+
+    Children of every node are emitted from most to least common branch with
+    conclusion leaves last. All emitted nodes come out fully annotated with
+    their `depth`, `num_descendants`, and `class_counts` properties: depths
+    are threaded through the work items while descendant and class counts
+    are aggregated post-order through finalization markers that get popped
+    once the entire subtree of a node has been constructed. When `merge` is
+    set, chains of trie nodes with a single child and no leaves are
+    compressed into a single node with a conjunctive label.
+
+    :param _TrieNode root: The root node of the trie we want to emit.
+    :param List[_RuleView] rule_views: Map between each rule ID and its rule
+        view.
+    :param Dict[int, str] label_cache: Map between each term bit and the HTML
+        label of the corresponding term.
+    :param Dict[object, str] conclusion_labels: Map between each distinct
+        conclusion in the rule set and its HTML label.
+    :param bool merge: Whether or not we want to series of branches with only
+        one child into a single child with a longer premise or not.
+    """
+    result = []
+    # Work items are (parent_children, term_bit, trie_node, depth) tuples
+    # while (None, node_dict, rule_ids, depth) entries act as finalization
+    # markers: they sit below all the work items of their subtree and hence
+    # get popped exactly when that subtree is complete, at which point the
+    # node's conclusion leaves are appended after its children and its
+    # annotations aggregated. The marker of the (virtual) root node appends
+    # the leaves of rules with an empty premise at the top level instead
+    stack = deque()
+    stack.append((None, None, root.rule_ids, 1))
+    for bit, child in sorted(
+        root.children.items(),
+        key=_trie_child_sort_key,
+        reverse=True,
+    ):
+        stack.append((result, bit, child, 1))
+    while stack:
+        item = stack.pop()
+        if item[0] is None:
+            # [FINALIZATION MARKER]
+            _, node_dict, rule_ids, depth = item
+            target = result if node_dict is None else node_dict["children"]
+            for rule_id in rule_ids:
+                view = rule_views[rule_id]
+                label = conclusion_labels[view.conclusion]
+                target.append({
+                    "name": label,
+                    "children": [],
+                    "score": view.score,
+                    "depth": depth,
+                    "num_descendants": 0,
+                    "class_counts": {
+                        label: 1,
+                    },
+                })
+            if node_dict is not None:
+                _finalize_node(node_dict)
+            continue
+
+        parent_children, bit, node, depth = item
+        children = node.children
+        rule_ids = node.rule_ids
+        labels = [label_cache[bit]]
+        if node.count == 1:
+            # [LEAF CHAIN FAST PATH]
+            # Exactly one rule passes through this node, so its subtree is a
+            # straight chain ending in that rule's conclusion leaf and can be
+            # emitted in a single bottom-up pass
+            while children:
+                # popitem() avoids allocating a dict iterator just to fetch
+                # the chain's only entry; the trie is discarded right after
+                # emission so consuming it here is harmless
+                chain_bit, child = children.popitem()
+                labels.append(label_cache[chain_bit])
+                children = child.children
+                rule_ids = child.rule_ids
+            parent_children.append(_emit_rule_chain(
+                labels=labels,
+                view=rule_views[rule_ids[0]],
+                conclusion_labels=conclusion_labels,
+                depth=depth,
+                merge=merge,
+            ))
+            continue
+        if merge:
+            # Compress chains of single-child nodes without leaves into one
+            # conjunctive node for ease of visibility in the graph
+            while len(children) == 1 and not rule_ids:
+                chain_bit, child = children.popitem()
+                labels.append(label_cache[chain_bit])
+                children = child.children
+                rule_ids = child.rule_ids
+        next_node = {
+            "name": " AND ".join(labels),
+            "children": [],
+            "depth": depth,
+        }
+        parent_children.append(next_node)
+        stack.append((None, next_node, rule_ids, depth + 1))
+        for child_bit, child in sorted(
+            children.items(),
+            key=_trie_child_sort_key,
+            reverse=True,
+        ):
+            stack.append((next_node["children"], child_bit, child, depth + 1))
+    return result
+
+
+def _extract_hierarchy_node(rules, dataset=None, merge=False):
+    """
+    Produces a D3 Hierarchical Tree structure from the given rules.
+
+    This tree will be generated by ordering the terms of every rule from
+    globally most to least commonly used and merging the resulting shared
+    prefixes, so that the most commonly used terms end up as early split
     nodes in the tree.
     Leaf nodes in the graph correspond to rules in the ruleset in a one-to-one
     fashion and each split node corresponds to a term used in the rule set.
@@ -149,163 +441,43 @@ def _extract_hierarchy_node(ruleset, dataset=None, merge=False):
         "score": a float representing the score of the rule represented by
                  this leaf node.
 
-    :param Ruleset ruleset: The ruleset object we want to extract a D3
+    In addition, every node is annotated with its "depth" in the tree, the
+    number of nodes in its subtree ("num_descendants"), and the distribution
+    of conclusions of the leaves in its subtree ("class_counts").
+
+    :param Iterable[Rule] rules: The rules we want to extract a D3
         hierarchical tree from.
     :param DatasetDescriptor dataset: An optional dataset descriptor for the
         given rule set which can help with annotations during visualization.
     :param bool merge: Whether or not we want to series of branches with only
         one child into a single child with a longer premise or not.
     """
-    if not len(ruleset):
-        return []
-    if len(ruleset) == 1:
-        # [BASE CASE]
-        # Then simply output this rule (which is expected to have exactly one
-        # clause)
-        rule = next(iter(ruleset.rules))
-        clause = next(iter(rule.premise)) if len(rule.premise) else None
-        conclusion_node = {
-            "name": _htmlify(str(rule.conclusion)),
-            "children": [],
-            "score": clause.score if clause is not None else 0,
-        }
-        if (clause is not None) and len(clause.terms):
-            if merge:
-                # Then we still have some terms left but we will not partition
-                # on them as it will simply generate a chain
-                return [
-                    {
-                        "name": _htmlify(" AND ".join(
-                            map(
-                                lambda x: x.to_cat_str(dataset)
-                                if dataset is not None else str(x),
-                                clause.terms
-                            )
-                        )),
-                        "children": [conclusion_node],
-                    },
-                ]
-            else:
-                first = None
-                current = None
-                for term in clause.terms:
-                    if current is None:
-                        current = {
-                            "name": _htmlify(
-                                term.to_cat_str(dataset)
-                                if dataset is not None else str(term)
-                            ),
-                            "children": [],
-                        }
-                        first = current
-                    else:
-                        next_elem = {
-                            "name": _htmlify(
-                                term.to_cat_str(dataset)
-                                if dataset is not None else str(term)
-                            ),
-                            "children": [],
-                        }
-                        current["children"].append(next_elem)
-                        current = next_elem
-                # Finally add the conclusion
-                current["children"].append(conclusion_node)
-                return [first]
-
-        # Else this is our terminal case and we add the conclusion node and
-        # nothing else
-        return [conclusion_node]
-
-    # [RECURSIVE CASE]
-
-    # Sort our nodes by the greedy metric of interest
-    sorted_terms, term_count_map = _get_term_counts(
-        ruleset=ruleset,
-    )
-
-    # Look at the first little bastard as this is
-    # the best split in order
-    next_term = sorted_terms[0]
-    # Partition our ruleset around the current term
-    contain_ruleset, disjoint_ruleset = _partition_ruleset(
-        ruleset=ruleset,
-        term=next_term,
-    )
-
-    # Construct the node for this term recursively by including it
-    # in the exclude list
-    next_node = {
-        "name": _htmlify(
-            next_term.to_cat_str(dataset)
-            if dataset is not None else str(next_term)
-        ),
-        "children": _extract_hierarchy_node(
-            ruleset=contain_ruleset,
-            dataset=dataset,
-            merge=merge,
-        ),
-    }
-
-    # And return the result of adding this guy to our list and the
-    # children resulting from the rules that do not contain it
-    return [next_node] + _extract_hierarchy_node(
-        ruleset=disjoint_ruleset,
+    # Index the rule set and compute its term frequency distribution exactly
+    # once, then build the frequency-ordered trie of all rules and emit it as
+    # a D3 tree in a single traversal
+    rule_views, clause_masks, bit_to_term = _build_term_index(rules=rules)
+    counts = _get_term_counts(clause_masks=clause_masks)
+    label_cache, conclusion_labels = _build_label_cache(
+        bit_to_term=bit_to_term,
+        rule_views=rule_views,
         dataset=dataset,
+    )
+    trie = _build_trie(clause_masks=clause_masks, counts=counts)
+    return _emit_trie(
+        root=trie,
+        rule_views=rule_views,
+        label_cache=label_cache,
+        conclusion_labels=conclusion_labels,
         merge=merge,
     )
 
 
-def _compute_tree_properties(tree, depth=0, merge=False):
-    """
-    Annotates the given D3 Hierarchical tree node representing a rule set with
-    annotations concerning properties of its children. It does this in a
-    recursive fashion by annotating nodes in the entire subtree rooted at
-    `tree`.
-
-    :param d3.Node tree: Current node in D3's hierarchical tree which we will
-        annotate.
-    :param int depth: Current depth of the given node.
-    :param bool merge: Whether or not we want to series of branches with only
-        one child into a single child with a longer premise or not.
-    """
-    tree["depth"] = depth
-    if len(tree["children"]) == 0:
-        # Then this is a leaf!
-        tree["num_descendants"] = 0
-        tree["class_counts"] = {
-            tree["name"]: 1,
-        }
-        return tree
-    if (depth != 0) and len(tree["children"]) == 1 and merge and (
-        len(tree["children"][0]["children"]) != 0
-    ):
-        # Then we can collapse this into a single node for ease of visibility
-        # in this graph
-        old_child = tree["children"][0]
-        tree["children"] = old_child["children"]
-        tree["name"] += " AND " + old_child["name"]
-
-    # Else proceed recursively
-    tree["num_descendants"] = 0
-    tree["class_counts"] = {}
-    class_counts = tree["class_counts"]
-    for child in tree["children"]:
-        child = _compute_tree_properties(child, depth=(depth + 1))
-        tree["num_descendants"] += child["num_descendants"] + 1
-        for class_name, count in child["class_counts"].items():
-            class_counts[class_name] = count + class_counts.get(
-                class_name,
-                0
-            )
-    return tree
-
-
 def ruleset_hierarchy_tree(ruleset, dataset=None, merge=False):
     """
     Given a Ruleset `ruleset`, this method will produce a D3 Hierarchical tree
-    representation of the same ruleset using a greedy n-ary decision tree
-    induction where we group individual rules in the rule set using the most
-    commonly used terms found across all rules.
+    representation of the same ruleset as an n-ary tree where we group
+    individual rules in the rule set using the most commonly used terms found
+    across all rules.
 
     :param Ruleset ruleset: The ruleset object we want to extract a D3
         hierarchical tree from.
@@ -314,12 +486,24 @@ def ruleset_hierarchy_tree(ruleset, dataset=None, merge=False):
     :param bool merge: Whether or not we want to series of branches with only
         one child into a single child with a longer premise or not.
     """
+    # Only this public entry point ever touches the Ruleset object itself;
+    # all the helpers below work on plain rule views so that no intermediate
+    # Ruleset/Rule objects need to be allocated during tree construction.
+    # `ruleset.rules` is a set so we snapshot it into a tuple here: that
+    # pins down a single iteration order for the whole extraction (rather
+    # than re-hashing rules on every pass over the set) and keeps the
+    # output stable if the rule set is mutated while we build the tree.
+    # The extraction emits every node already annotated with its depth,
+    # descendant count, and class counts so only the root node itself is
+    # left to fill in here
     tree = {
         "name": "ruleset",
         "children": _extract_hierarchy_node(
-            ruleset=ruleset,
+            rules=tuple(ruleset.rules),
             dataset=dataset,
             merge=merge,
         ),
+        "depth": 0,
     }
-    return _compute_tree_properties(tree, merge=merge)
+    _finalize_node(tree)
+    return tree